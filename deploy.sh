@@ -16,14 +16,33 @@ BLUE='\033[0;34m'
 NC='\033[0m' # No Color
 
 echo -e "${BLUE}Step 1: Building Flutter web app...${NC}"
+
+# Stamp the build version into web/index.html before building, so the hash
+# flutter_service_worker.js records for index.html matches what is served.
+# E2E checks use it to tell fresh code from cached.
+# --dirty marks builds from uncommitted changes, so the stamp never claims
+# a commit that is not what got built
+APP_VERSION=$(git describe --always --dirty)
+if [[ "$APP_VERSION" == *-dirty ]]; then
+    echo "Warning: working tree has uncommitted changes; stamping $APP_VERSION"
+fi
+cp web/index.html web/index.html.orig
+trap 'mv -f web/index.html.orig web/index.html' EXIT
+sed -i.bak "s|window.__APP_VERSION__ = \"dev\"|window.__APP_VERSION__ = \"$APP_VERSION\"|" web/index.html
+rm -f web/index.html.bak
+
 flutter build web --release --base-href /hex_buzz/
 
+# Restore the unstamped template
+mv -f web/index.html.orig web/index.html
+trap - EXIT
+
 if [ ! -d "$BUILD_DIR" ]; then
     echo "Error: Build directory not found at $BUILD_DIR"
     exit 1
 fi
 
-echo -e "${GREEN}✓ Build completed${NC}"
+echo -e "${GREEN}✓ Build completed (version $APP_VERSION)${NC}"
 
 echo -e "${BLUE}Step 2: Preparing VPS deployment directory...${NC}"
 ssh "$VPS_HOST" "mkdir -p $VPS_DEPLOY_PATH"
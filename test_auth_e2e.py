@@ -4,232 +4,387 @@ E2E test for HexBuzz authentication and session persistence.
 Tests both guest and Google login flows.
 """
 
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import queue
 import sys
-import time
-from playwright.sync_api import sync_playwright, expect
+from playwright.async_api import async_playwright, expect
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 
 APP_URL = "https://mondo-ai-studio.xvps.jp/hex_buzz"
 
-def test_guest_session_persistence():
-    """Test that guest session persists after page reload."""
-    print("\n=== Test 1: Guest Session Persistence ===")
+log = logging.getLogger("hex_buzz.e2e")
+
+# Build version stamped into index.html by deploy.sh (`git describe`);
+# only compared when set explicitly, since the local checkout may be ahead
+# of what was deployed. "dev" means an unstamped local build
+EXPECTED_APP_VERSION = os.environ.get("EXPECTED_APP_VERSION")
+UNSTAMPED_VERSION = "dev"
+
+# Shared Chromium launch flags (no X server / small /dev/shm in CI); also
+# turns off background services that only slow down a cold start
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-sync",
+    "--no-first-run",
+    "--mute-audio",
+    "--disable-features=TranslateUI,site-per-process",
+]
+
+# Fixed, modest viewport for every context
+VIEWPORT = {"width": 1024, "height": 768}
+
+# Debug logs emitted by the new auth code
+NEW_CODE_LOGS = ("Firebase Auth persistence", "HybridAuth")
+AUTH_LOGS = NEW_CODE_LOGS + ("Auth cache HIT",)
+
+# Keeps matching console.log lines in window.__e2eLogs so the rest of the
+# app's logging never crosses CDP
+CAPTURE_LOGS_JS = """(() => {
+    const needles = %s;
+    const original = console.log;
+    window.__e2eLogs = [];
+    console.log = (...args) => {
+        const text = args.join(' ');
+        if (needles.some((needle) => text.includes(needle))) {
+            window.__e2eLogs.push(text);
+        }
+        original.apply(console, args);
+    };
+})()""" % json.dumps(AUTH_LOGS)
+
+# Saved guest session (cookies + localStorage) from the first login
+GUEST_STATE_PATH = "/tmp/hb_state.json"
+
+# Guest usernames, matched in-browser by GREETING_JS
+GUEST_PATTERN = r"Guest-\w+"
+
+# Text shown once a user is signed in
+LOGGED_IN_SELECTOR = "text=/Guest-|Hi,/"
+
+# Reads the greeting in-browser so only a tiny object crosses CDP
+GREETING_JS = """(guestPattern) => {
+    const text = document.body.innerText;
+    const match = text.match(new RegExp(guestPattern));
+    return {username: match && match[0], hi: text.includes('Hi,')};
+}"""
+
+def start_logging():
+    """Route log records through a queue so the event loop never blocks on stdout."""
+    records = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(records, logging.StreamHandler(sys.stdout))
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    listener.start()
+    return listener
+
+async def snap(page, name):
+    """Save a small viewport JPEG for a failure; green runs take none."""
+    path = f"/tmp/hex_buzz_{name}.jpg"
+    await page.screenshot(path=path, full_page=False, type="jpeg", quality=60)
+    log.info(f"   Screenshot saved: {path}")
+
+def scan_logs(console_logs, needles):
+    """Return the subset of needles seen in console_logs, in a single pass."""
+    found = set()
+    for line in console_logs:
+        for needle in needles:
+            if needle not in found and needle in line:
+                found.add(needle)
+        if len(found) == len(needles):
+            break
+    return found
+
+async def read_app_version(page):
+    """Return the deployed build version, or None if the page has no stamp."""
+    version = await page.evaluate("() => window.__APP_VERSION__ || null")
+    return None if version == UNSTAMPED_VERSION else version
+
+async def read_greeting(page):
+    """Return the signed-in username/greeting state of the current page."""
+    return await page.evaluate(GREETING_JS, GUEST_PATTERN)
+
+async def wait_for_logged_in(page, username=None, timeout=10000):
+    """Wait until the greeting or username is rendered (no-op on timeout)."""
+    target = page.locator(LOGGED_IN_SELECTOR)
+    if username:
+        target = page.locator(f"text={username}").or_(target)
+    try:
+        await target.first.wait_for(state="visible", timeout=timeout)
+    except PlaywrightTimeoutError:
+        pass
+
+async def capture_logs(page):
+    """Install the in-page console filter; must run before navigation."""
+    await page.add_init_script(CAPTURE_LOGS_JS)
+
+async def collected_logs(page):
+    """Fetch the console lines captured by CAPTURE_LOGS_JS."""
+    return await page.evaluate("window.__e2eLogs || []")
+
+async def wait_for_console(page, needles, timeout=10000):
+    """Wait for the load event, then for a captured log containing any needle."""
+    await page.wait_for_function(
+        "() => performance.getEntriesByType('navigation')[0].loadEventEnd > 0",
+        timeout=timeout,
+    )
+    try:
+        await page.wait_for_function(
+            """(needles) => (window.__e2eLogs || []).some(
+                (log) => needles.some((needle) => log.includes(needle)))""",
+            arg=list(needles),
+            timeout=timeout,
+        )
+    except PlaywrightTimeoutError:
+        pass
 
-    with sync_playwright() as p:
-        # Launch browser in headless mode (no X server available)
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context()
+async def new_guest_context(browser):
+    """Open a context already signed in as the saved guest, skipping login."""
+    return await browser.new_context(storage_state=GUEST_STATE_PATH, viewport=VIEWPORT)
 
-        # Clear cache and storage
-        context.clear_cookies()
+async def test_guest_session_persistence(browser):
+    """Test that a saved guest session is restored in a fresh browser context."""
+    log.info("\n=== Test 1: Guest Session Persistence ===")
 
-        page = context.new_page()
+    context = await browser.new_context(storage_state=None, viewport=VIEWPORT)
+    restored = None
 
-        # Enable console logging
-        page.on("console", lambda msg: print(f"[Browser] {msg.text}"))
+    # Clear cache and storage
+    await context.clear_cookies()
 
-        print(f"1. Navigating to {APP_URL}")
-        page.goto(APP_URL, wait_until="networkidle")
-        time.sleep(2)
+    page = await context.new_page()
 
-        # Take screenshot of initial state
-        page.screenshot(path="/tmp/hex_buzz_01_initial.png")
-        print("   Screenshot saved: /tmp/hex_buzz_01_initial.png")
+    # Enable console logging
+    page.on("console", lambda msg: log.info(f"[Browser] {msg.text}"))
 
-        # Check for "Play as Guest" button
-        print("2. Looking for 'Play as Guest' button...")
-        try:
-            guest_button = page.locator("text=/Play as Guest|Continue as Guest/i")
-            if guest_button.is_visible(timeout=5000):
-                print("   ✓ Found guest button")
-                page.screenshot(path="/tmp/hex_buzz_02_before_guest.png")
-
-                print("3. Clicking 'Play as Guest'...")
-                guest_button.click()
-                time.sleep(3)
-
-                page.screenshot(path="/tmp/hex_buzz_03_after_guest.png")
-                print("   Screenshot saved: /tmp/hex_buzz_03_after_guest.png")
-
-                # Check if we see "Hi, Guest" or username
-                print("4. Checking for user greeting...")
-                page_text = page.content()
-                if "Guest-" in page_text or "Hi," in page_text:
-                    print("   ✓ Guest logged in successfully")
-
-                    # Get the username
-                    username = None
-                    if "Guest-" in page_text:
-                        import re
-                        match = re.search(r'Guest-\w+', page_text)
-                        if match:
-                            username = match.group(0)
-                            print(f"   Username: {username}")
-
-                    # Test session persistence: reload page
-                    print("5. Reloading page to test session persistence...")
-                    page.reload(wait_until="networkidle")
-                    time.sleep(3)
-
-                    page.screenshot(path="/tmp/hex_buzz_04_after_reload.png")
-                    print("   Screenshot saved: /tmp/hex_buzz_04_after_reload.png")
-
-                    # Check if still logged in
-                    page_text_after = page.content()
-                    if username and username in page_text_after:
-                        print(f"   ✅ SUCCESS: Session persisted! Still see {username}")
-                        return True
-                    elif "Guest-" in page_text_after or "Hi," in page_text_after:
-                        print(f"   ⚠️  PARTIAL: Logged in but different username")
-                        return False
-                    else:
-                        print(f"   ❌ FAILED: Session lost after reload")
-                        print(f"   Expected to see username, but page shows login screen")
-                        return False
-                else:
-                    print("   ❌ FAILED: Guest login didn't work")
-                    return False
+    log.info(f"1. Navigating to {APP_URL}")
+    await page.goto(APP_URL, wait_until="networkidle")
+
+    # Check for "Play as Guest" button
+    log.info("2. Looking for 'Play as Guest' button...")
+    try:
+        guest_button = page.locator("text=/Play as Guest|Continue as Guest/i")
+        await expect(guest_button).to_be_visible(timeout=5000)
+        log.info("   ✓ Found guest button")
+
+        log.info("3. Clicking 'Play as Guest'...")
+        await guest_button.click()
+        await wait_for_logged_in(page)
+
+        # Check if we see "Hi, Guest" or username
+        log.info("4. Checking for user greeting...")
+        greeting = await read_greeting(page)
+        if greeting["username"] or greeting["hi"]:
+            log.info("   ✓ Guest logged in successfully")
+
+            # Get the username
+            username = greeting["username"]
+            if username:
+                log.info(f"   Username: {username}")
+
+            # Save the session so later contexts can start signed in
+            await context.storage_state(path=GUEST_STATE_PATH)
+            log.info(f"   Session saved: {GUEST_STATE_PATH}")
+
+            # Test session persistence: load saved state in a new context
+            log.info("5. Reopening app with saved session...")
+            restored = await new_guest_context(browser)
+            page = await restored.new_page()
+            await page.goto(APP_URL, wait_until="networkidle")
+            # One wait covers both outcomes; the greeting tells them apart
+            await wait_for_logged_in(page, username)
+
+            # Check if still logged in
+            greeting_after = await read_greeting(page)
+            if username and greeting_after["username"] == username:
+                log.info(f"   ✅ SUCCESS: Session persisted! Still see {username}")
+                return True
+            elif greeting_after["username"] or greeting_after["hi"]:
+                log.info(f"   ⚠️  PARTIAL: Logged in but different username")
+                await snap(page, "04_after_restore")
+                return False
             else:
-                print("   ❌ Button not found")
+                log.info(f"   ❌ FAILED: Session not restored from saved state")
+                log.info(f"   Expected to see username, but page shows login screen")
+                await snap(page, "04_after_restore")
                 return False
-        except Exception as e:
-            print(f"   ❌ Error: {e}")
-            page.screenshot(path="/tmp/hex_buzz_error.png")
+        else:
+            log.info("   ❌ FAILED: Guest login didn't work")
+            await snap(page, "03_after_guest")
             return False
-        finally:
-            browser.close()
-
-def test_service_worker_version():
+    except Exception as e:
+        log.info(f"   ❌ Error: {e}")
+        await snap(page, "error")
+        return False
+    finally:
+        if restored is not None:
+            await restored.close()
+        await context.close()
+
+async def test_service_worker_version(browser):
     """Check if service worker is caching old code."""
-    print("\n=== Test 2: Service Worker Check ===")
-
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context()
-        page = context.new_page()
-
-        # Enable console logging
-        console_logs = []
-        page.on("console", lambda msg: console_logs.append(msg.text))
+    log.info("\n=== Test 2: Service Worker Check ===")
+
+    # Service workers stay on: this test is about what the SW serves
+    context = await browser.new_context(
+        storage_state=None,
+        viewport=VIEWPORT,
+        service_workers="allow",
+    )
+    try:
+        page = await context.new_page()
+
+        # Capture auth debug logs in-page
+        await capture_logs(page)
+
+        log.info(f"1. Navigating to {APP_URL}")
+        await page.goto(APP_URL, wait_until="networkidle")
+
+        # Cheap path: compare the stamped build version
+        version = await read_app_version(page)
+        if version is not None and EXPECTED_APP_VERSION is not None:
+            log.info(f"2. Checking build version: {version}")
+            if version == EXPECTED_APP_VERSION:
+                log.info("   ✅ New code is loaded")
+                return True
+            log.info(f"   ❌ WARNING: Expected {EXPECTED_APP_VERSION}! Service worker caching old version")
+            return False
 
-        print(f"1. Navigating to {APP_URL}")
-        page.goto(APP_URL, wait_until="networkidle")
-        time.sleep(5)
+        # Unstamped build or nothing to compare against: fall back to auth debug logs
+        await wait_for_console(page, NEW_CODE_LOGS)
+        console_logs = await collected_logs(page)
 
         # Check console logs for our debug messages
-        print("2. Checking console logs...")
-        has_persistence = any("Firebase Auth persistence" in log for log in console_logs)
-        has_hybrid_auth = any("HybridAuth" in log for log in console_logs)
-        has_cache_hit = any("Auth cache HIT" in log for log in console_logs)
+        log.info("2. No build version to compare, checking console logs...")
+        found = scan_logs(console_logs, AUTH_LOGS)
+        has_persistence = "Firebase Auth persistence" in found
+        has_hybrid_auth = "HybridAuth" in found
+        has_cache_hit = "Auth cache HIT" in found
 
-        print(f"   Firebase Auth persistence log: {'✓' if has_persistence else '✗'}")
-        print(f"   HybridAuth debug logs: {'✓' if has_hybrid_auth else '✗'}")
-        print(f"   Cache hit logs: {'✓' if has_cache_hit else '✗'}")
+        log.info(f"   Firebase Auth persistence log: {'✓' if has_persistence else '✗'}")
+        log.info(f"   HybridAuth debug logs: {'✓' if has_hybrid_auth else '✗'}")
+        log.info(f"   Cache hit logs: {'✓' if has_cache_hit else '✗'}")
 
         if not has_persistence and not has_hybrid_auth:
-            print("   ❌ WARNING: New code not loaded! Service worker caching old version")
-            print("\n   Recent console logs:")
-            for log in console_logs[-10:]:
-                print(f"   - {log}")
+            log.info("   ❌ WARNING: New code not loaded! Service worker caching old version")
+            log.info("\n   Recent auth console logs:")
+            for line in console_logs[-10:]:
+                log.info(f"   - {line}")
             return False
         else:
-            print("   ✅ New code is loaded")
+            log.info("   ✅ New code is loaded")
             return True
+    finally:
+        await context.close()
 
-        browser.close()
-
-def test_cache_clearing():
+async def test_cache_clearing(browser):
     """Test with completely fresh browser state."""
-    print("\n=== Test 3: Fresh Browser (No Cache) ===")
-
-    with sync_playwright() as p:
-        # Launch with no storage
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(
-            storage_state=None,
-            ignore_https_errors=False,
-        )
-        page = context.new_page()
+    log.info("\n=== Test 3: Fresh Browser (No Cache) ===")
+
+    # Fresh context with no storage and no service worker, so every
+    # request goes to the network
+    context = await browser.new_context(
+        storage_state=None,
+        viewport=VIEWPORT,
+        ignore_https_errors=False,
+        service_workers="block",
+    )
+    try:
+        page = await context.new_page()
 
         # Clear everything
-        print("1. Clearing all browser data...")
-        context.clear_cookies()
-
-        # Enable console logging
-        console_logs = []
-        page.on("console", lambda msg: console_logs.append(msg.text))
+        log.info("1. Clearing all browser data...")
+        await context.clear_cookies()
 
-        # Navigate with hard reload
-        print(f"2. Navigating to {APP_URL} (hard reload)...")
-        page.goto(APP_URL, wait_until="domcontentloaded")
+        # Capture auth debug logs in-page
+        await capture_logs(page)
 
-        # Force reload to bypass service worker
-        page.evaluate("navigator.serviceWorker.getRegistrations().then(registrations => {for(let reg of registrations) {reg.unregister()}})")
-        print("   Unregistered service workers")
+        log.info(f"2. Navigating to {APP_URL} (service workers blocked)...")
+        await page.goto(APP_URL, wait_until="networkidle")
+        await wait_for_console(page, NEW_CODE_LOGS)
+        console_logs = await collected_logs(page)
 
-        page.reload(wait_until="networkidle")
-        time.sleep(5)
+        log.info("3. Checking console logs...")
+        log.info("\n   Auth console logs:")
+        for line in console_logs:
+            log.info(f"   {line}")
 
-        print("3. Checking console logs...")
-        print("\n   All console logs:")
-        for log in console_logs:
-            print(f"   {log}")
-
-        has_new_code = any("HybridAuth" in log or "Firebase Auth persistence" in log for log in console_logs)
+        has_new_code = bool(scan_logs(console_logs, NEW_CODE_LOGS))
 
         if has_new_code:
-            print("\n   ✅ Fresh load shows new code")
+            log.info("\n   ✅ Fresh load shows new code")
             return True
         else:
-            print("\n   ❌ Even fresh load shows old code - deployment issue?")
+            log.info("\n   ❌ Even fresh load shows old code - deployment issue?")
             return False
+    finally:
+        await context.close()
+
+async def main():
+    log.info("=" * 60)
+    log.info("HexBuzz E2E Authentication Tests")
+    log.info("=" * 60)
+
+    # One browser for the whole run; the three tests are independent, so
+    # they run side by side, each in its own context
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(
+            headless=True,
+            args=CHROMIUM_ARGS,
+            chromium_sandbox=False,
+        )
+        try:
+            sw_ok, fresh_ok, guest_ok = await asyncio.gather(
+                test_service_worker_version(browser),
+                test_cache_clearing(browser),
+                test_guest_session_persistence(browser),
+            )
+        finally:
+            await browser.close()
 
-        browser.close()
-
-def main():
-    print("=" * 60)
-    print("HexBuzz E2E Authentication Tests")
-    print("=" * 60)
-
-    # Test 1: Service worker check
-    sw_ok = test_service_worker_version()
-
-    # Test 2: Cache clearing
-    fresh_ok = test_cache_clearing()
-
-    # Test 3: Guest session
-    if sw_ok or fresh_ok:
-        guest_ok = test_guest_session_persistence()
-    else:
-        print("\n⚠️  Skipping guest test - new code not loading")
+    # Guest result only means something once the new code is loading
+    if not (sw_ok or fresh_ok):
+        log.info("\n⚠️  Ignoring guest test - new code not loading")
         guest_ok = False
 
-    print("\n" + "=" * 60)
-    print("Test Results Summary")
-    print("=" * 60)
-    print(f"Service Worker Check: {'✅ PASS' if sw_ok else '❌ FAIL'}")
-    print(f"Fresh Browser Load:   {'✅ PASS' if fresh_ok else '❌ FAIL'}")
-    print(f"Guest Session:        {'✅ PASS' if guest_ok else '❌ FAIL'}")
-    print("=" * 60)
+    log.info("\n" + "=" * 60)
+    log.info("Test Results Summary")
+    log.info("=" * 60)
+    log.info(f"Service Worker Check: {'✅ PASS' if sw_ok else '❌ FAIL'}")
+    log.info(f"Fresh Browser Load:   {'✅ PASS' if fresh_ok else '❌ FAIL'}")
+    log.info(f"Guest Session:        {'✅ PASS' if guest_ok else '❌ FAIL'}")
+    log.info("=" * 60)
 
     if not (sw_ok or fresh_ok):
-        print("\n⚠️  ISSUE: New code not loading even with cache cleared")
-        print("   Possible causes:")
-        print("   1. Service worker caching old version")
-        print("   2. Deployment didn't complete")
-        print("   3. CDN/proxy caching")
-        print("\nScreenshots saved to /tmp/hex_buzz_*.png")
+        log.info("\n⚠️  ISSUE: New code not loading even with cache cleared")
+        log.info("   Possible causes:")
+        log.info("   1. Service worker caching old version")
+        log.info("   2. Deployment didn't complete")
+        log.info("   3. CDN/proxy caching")
+        log.info("\nScreenshots saved to /tmp/hex_buzz_*.jpg")
         return 1
     elif not guest_ok:
-        print("\n⚠️  ISSUE: Session not persisting after page reload")
-        print("   Check screenshots at /tmp/hex_buzz_*.png")
+        log.info("\n⚠️  ISSUE: Guest session not restored from saved state")
+        log.info("   Check screenshots at /tmp/hex_buzz_*.jpg")
         return 1
     else:
-        print("\n✅ All tests passed!")
+        log.info("\n✅ All tests passed!")
         return 0
 
 if __name__ == "__main__":
+    listener = start_logging()
     try:
-        sys.exit(main())
+        sys.exit(asyncio.run(main()))
     except KeyboardInterrupt:
-        print("\n\nTests interrupted")
+        log.info("\n\nTests interrupted")
         sys.exit(1)
+    finally:
+        listener.stop()
@@ -27,6 +27,8 @@ from googleapiclient.http import MediaFileUpload
 
 PACKAGE_NAME = "blog.techvisual.hexbuzz"
 SCOPES = ["https://www.googleapis.com/auth/androidpublisher"]
+# Resumable upload chunk size (must be a multiple of 256 KB)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
 
 
 def get_service(key_file: str):
@@ -47,14 +49,23 @@ def upload_aab(service, aab_path: str, track: str = "internal"):
     print(f"Created edit: {edit_id}")
 
     try:
-        # Upload the AAB
-        media = MediaFileUpload(aab_path, mimetype="application/octet-stream")
-        bundle = (
+        # Upload the AAB in chunks so memory stays flat and failures can resume
+        media = MediaFileUpload(
+            aab_path,
+            mimetype="application/octet-stream",
+            resumable=True,
+            chunksize=UPLOAD_CHUNK_SIZE,
+        )
+        request = (
             service.edits()
             .bundles()
             .upload(packageName=PACKAGE_NAME, editId=edit_id, media_body=media)
-            .execute()
         )
+        bundle = None
+        while bundle is None:
+            status, bundle = request.next_chunk(num_retries=3)
+            if status:
+                print(f"Uploaded {int(status.progress() * 100)}%")
         version_code = bundle["versionCode"]
         print(f"Uploaded bundle version: {version_code}")
 
@@ -12,23 +12,62 @@ Configuration:
 - Background removal: rembg for icons (transparent PNG)
 """
 
+import argparse
 import base64
+import functools
+import hashlib
 import io
+import json
+import logging
+import logging.handlers
 import os
+import queue
 import requests
+import shutil
+import sys
+import tempfile
+from concurrent.futures import Future, Executor, ThreadPoolExecutor
 from pathlib import Path
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+log = logging.getLogger("hex_buzz.sd_assets")
+
+# PIL is only needed to feed rembg; assets without remove_bg are written
+# exactly as decoded from the API response, with no image decode/encode.
 try:
-    from rembg import remove as remove_background
+    from PIL import Image
+    from rembg import new_session, remove as remove_background
     REMBG_AVAILABLE = True
 except ImportError:
     REMBG_AVAILABLE = False
-    print("Warning: rembg not installed. Run 'pip install rembg' for transparent icons.")
+    log.warning("Warning: rembg not installed. Run 'pip install rembg' for transparent icons.")
 
 # Configuration
 API_URL = "http://localhost:7860"
+MODEL_CHECKPOINT = "dreamshaperXL_lightningDPMSDE.safetensors"
+# Concurrent txt2img requests; kept small since the GPU is the bottleneck
+MAX_WORKERS = 2
+# Background removal runs off the request threads so the GPU stays busy
+POSTPROCESS_WORKERS = 1
 OUTPUT_DIR = Path(__file__).parent.parent / "assets" / "images"
+# Content-addressed cache of finished assets, keyed by generation settings.
+# Lives outside assets/ so it is never bundled into the app.
+CACHE_DIR = Path(__file__).parent / ".sd_cache"
+
+# Shared HTTP session: keeps connections to the API alive across requests/threads.
+# txt2img has no side effects, so POSTs are safe to retry on gateway errors.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({"GET", "POST"}),
+    ),
+))
 
 # SD settings for DreamShaper XL Lightning
 SD_CONFIG = {
@@ -229,28 +268,41 @@ ASSETS = {
 
 def ensure_model():
     """Ensure the correct model is loaded."""
-    print("Checking current model...")
-    response = requests.get(f"{API_URL}/sdapi/v1/options")
+    log.info("Checking current model...")
+    response = SESSION.get(f"{API_URL}/sdapi/v1/options")
     current = response.json().get("sd_model_checkpoint", "")
 
-    target_model = "dreamshaperXL_lightningDPMSDE.safetensors"
+    target_model = MODEL_CHECKPOINT
     if target_model not in current:
-        print(f"Switching to {target_model}...")
-        requests.post(
+        log.info(f"Switching to {target_model}...")
+        SESSION.post(
             f"{API_URL}/sdapi/v1/options",
             json={"sd_model_checkpoint": target_model}
         )
-        print("Model switched.")
+        log.info("Model switched.")
     else:
-        print(f"Already using {target_model}")
+        log.info(f"Already using {target_model}")
 
 
-def generate_image(prompt: str, negative: str, width: int = 512, height: int = 512) -> bytes:
-    """Generate an image using the SD API."""
-    payload = {
+def warmup_model():
+    """Run a tiny 1-step generation so model/VAE/sampler load before real assets."""
+    log.info("Warming up model...")
+    generate_image(prompt="warmup", negative="", width=64, height=64, steps=1)
+    log.info("Model ready.")
+
+
+def build_payload(
+    prompt: str,
+    negative: str,
+    width: int = 512,
+    height: int = 512,
+    steps: int | None = None,
+) -> dict:
+    """Build the txt2img request body."""
+    return {
         "prompt": prompt,
         "negative_prompt": negative or SD_CONFIG["negative_prompt"],
-        "steps": SD_CONFIG["steps"],
+        "steps": steps or SD_CONFIG["steps"],
         "cfg_scale": SD_CONFIG["cfg_scale"],
         "width": width,
         "height": height,
@@ -260,67 +312,185 @@ def generate_image(prompt: str, negative: str, width: int = 512, height: int = 5
         "n_iter": 1,
     }
 
-    response = requests.post(f"{API_URL}/sdapi/v1/txt2img", json=payload)
+
+def generate_image(
+    prompt: str,
+    negative: str,
+    width: int = 512,
+    height: int = 512,
+    steps: int | None = None,
+) -> bytes:
+    """Generate an image using the SD API."""
+    payload = build_payload(prompt, negative, width, height, steps)
+
+    response = SESSION.post(f"{API_URL}/sdapi/v1/txt2img", json=payload)
     response.raise_for_status()
 
-    result = response.json()
-    image_data = result["images"][0]
-    return base64.b64decode(image_data)
+    return base64.b64decode(response.json()["images"][0])
+
+
+@functools.lru_cache(maxsize=1)
+def rembg_session():
+    """Load the rembg ONNX model once and share it across all assets."""
+    return new_session()
 
 
 def apply_background_removal(image_data: bytes) -> bytes:
     """Remove background from image using rembg, return transparent PNG."""
     if not REMBG_AVAILABLE:
-        print("    Warning: rembg not available, skipping background removal")
+        log.warning("    Warning: rembg not available, skipping background removal")
         return image_data
 
-    input_image = Image.open(io.BytesIO(image_data))
-    output_image = remove_background(input_image)
+    with Image.open(io.BytesIO(image_data)) as input_image:
+        output_image = remove_background(input_image, session=rembg_session())
 
     output_buffer = io.BytesIO()
-    output_image.save(output_buffer, format="PNG")
+    # Fast zlib level: ~20% larger files, several times quicker to encode
+    output_image.save(output_buffer, format="PNG", optimize=False, compress_level=1)
     return output_buffer.getvalue()
 
 
-def generate_all_assets():
-    """Generate all game assets."""
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+def _asset_settings(config: dict) -> dict:
+    """Resolve an asset's generation settings against SD_CONFIG defaults."""
+    return {
+        "prompt": config["prompt"],
+        "negative": config.get("negative", SD_CONFIG["negative_prompt"]),
+        "width": config.get("width", SD_CONFIG["width"]),
+        "height": config.get("height", SD_CONFIG["height"]),
+    }
 
-    ensure_model()
 
-    total = len(ASSETS)
-    for i, (filename, config) in enumerate(ASSETS.items(), 1):
-        output_path = OUTPUT_DIR / filename
+def cache_path(config: dict) -> Path:
+    """Cache location for an asset, keyed on everything that affects its pixels."""
+    settings = _asset_settings(config)
+    key_data = {
+        "model": MODEL_CHECKPOINT,
+        "payload": build_payload(**settings),
+        "remove_bg": config.get("remove_bg", False) and REMBG_AVAILABLE,
+    }
+    key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+    return CACHE_DIR / f"{key}.png"
+
 
-        print(f"\n[{i}/{total}] Generating {filename}...")
+def _save_asset(
+    filename: str, image_data: bytes, remove_bg: bool, cached: Path
+) -> None:
+    """Post-process an asset and write it to the cache and output dir."""
+    output_path = OUTPUT_DIR / filename
 
-        width = config.get("width", SD_CONFIG["width"])
-        height = config.get("height", SD_CONFIG["height"])
-        negative = config.get("negative", SD_CONFIG["negative_prompt"])
-        remove_bg = config.get("remove_bg", False)
+    try:
+        if remove_bg:
+            log.info(f"    Removing background ({filename})...")
+            image_data = apply_background_removal(image_data)
 
+        # Write via a temp file so an interrupted run never leaves a
+        # truncated PNG under the content hash
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
         try:
-            image_data = generate_image(
-                prompt=config["prompt"],
-                negative=negative,
-                width=width,
-                height=height
-            )
-
-            if remove_bg:
-                print("    Removing background...")
-                image_data = apply_background_removal(image_data)
-
-            with open(output_path, "wb") as f:
+            with os.fdopen(fd, "wb") as f:
                 f.write(image_data)
+            os.replace(tmp_path, cached)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        shutil.copyfile(cached, output_path)
+
+        log.info(f"    Saved: {output_path}")
+
+    except Exception as e:
+        log.error(f"    ERROR ({filename}): {e}")
+
+
+def _one_asset(
+    index: int,
+    total: int,
+    filename: str,
+    config: dict,
+    post_pool: Executor,
+    force: bool = False,
+) -> Future | None:
+    """Generate a single asset; returns the pending post-process job, if any."""
+    output_path = OUTPUT_DIR / filename
+    cached = cache_path(config)
+
+    remove_bg = config.get("remove_bg", False)
+
+    try:
+        if not force and cached.exists():
+            shutil.copyfile(cached, output_path)
+            log.info(f"\n[{index}/{total}] Cached: {filename}")
+            return None
+
+        log.info(f"\n[{index}/{total}] Generating {filename}...")
+        image_data = generate_image(**_asset_settings(config))
+    except Exception as e:
+        log.error(f"    ERROR ({filename}): {e}")
+        return None
+
+    # Hand CPU-heavy rembg work off so this thread can issue the next request
+    if remove_bg:
+        return post_pool.submit(_save_asset, filename, image_data, True, cached)
+    _save_asset(filename, image_data, False, cached)
+    return None
+
+
+def generate_all_assets(force: bool = False):
+    """Generate all game assets."""
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
-            print(f"    Saved: {output_path}")
-
-        except Exception as e:
-            print(f"    ERROR: {e}")
+    # Only pay for the model switch/warmup if something needs generating
+    if force or not all(cache_path(config).exists() for config in ASSETS.values()):
+        ensure_model()
+        warmup_model()
 
-    print(f"\n✅ Asset generation complete! Files saved to {OUTPUT_DIR}")
+    total = len(ASSETS)
+    with ThreadPoolExecutor(max_workers=POSTPROCESS_WORKERS) as post_pool, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(_one_asset, i, total, filename, config, post_pool, force)
+            for i, (filename, config) in enumerate(ASSETS.items(), 1)
+        ]
+        try:
+            for future in futures:
+                post_job = future.result()
+                if post_job is not None:
+                    post_job.result()
+        except BaseException:
+            # Ctrl-C / fatal error: drop queued work so only in-flight jobs finish
+            executor.shutdown(wait=False, cancel_futures=True)
+            post_pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    log.info(f"\n✅ Asset generation complete! Files saved to {OUTPUT_DIR}")
+
+
+def start_logging():
+    """Route log records through a queue so worker threads never block on stdout."""
+    records = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(records, logging.StreamHandler(sys.stdout))
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    listener.start()
+    return listener
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate game assets with Stable Diffusion")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate every asset, ignoring the cache",
+    )
+    args = parser.parse_args()
+
+    listener = start_logging()
+    try:
+        generate_all_assets(force=args.force)
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
-    generate_all_assets()
+    main()